@@ -12,11 +12,16 @@ are used to explain functions."""
 
 # Installed libraries
 import os
+import glob
+import json
 import time
 import logging
+import argparse
+import threading
 import pandas as pd
 import google.oauth2.service_account as service_account
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -53,11 +58,39 @@ website = os.getenv("LOGIN_URL")
 # Get impersonated user email
 impersonated_user = os.getenv("IMPERSONATED_USER_EMAIL")
 
+# Default path to the backfill checkpoint file
+default_checkpoint_file = os.path.join(log_dir, 'backfill_checkpoint.json')
+
+# Calendar statuses that count as finished when resuming a backfill; errors are retried
+completed_statuses = {'Created', 'Updated', 'Deleted', 'Previously Deleted', 'Not Approved'}
+
+def read_leave_requests_file(excel_path):
+    """Read an Excel export and convert its time columns (kept at module level so a process pool can run it)"""
+    # Read Approval IDs as text so a blank cell can't turn them into floats like "12345.0"
+    df = pd.read_excel(excel_path, dtype={'Approval ID': str})
+    df = df.dropna(subset=['Approval ID'])
+    df['Approval ID'] = df['Approval ID'].str.strip()
+    
+    # Convert 'Start Time' and 'End Time' to datetime
+    df['Start Time'] = pd.to_datetime(df['Start Time'])
+    df['End Time'] = pd.to_datetime(df['End Time'])
+    return df
+
+def log_progress(stage, done, total, started):
+    """Log how far a backfill stage has got and an estimate of the time remaining"""
+    elapsed = time.time() - started
+    remaining = (elapsed / done) * (total - done) if done else 0
+    minutes, seconds = divmod(int(remaining), 60)
+    percent = (done / total) * 100 if total else 100
+    logging.info(f"{stage}: {done}/{total} ({percent:.1f}%), ETA {minutes}m{seconds:02d}s")
+
 # Main part of the function
 class LeaveRequestCalendar:
     def __init__(self, service_account_file, calendar_id, sheets_id=None):
         self.calendar_id = calendar_id
         self.sheets_id = sheets_id
+        self.service_account_file = service_account_file
+        self.deleted_lock = threading.Lock()  # Guards the deleted events file when events are deleted in parallel
         self.SCOPES = [
             'https://www.googleapis.com/auth/calendar',
             'https://www.googleapis.com/auth/spreadsheets'
@@ -244,10 +277,12 @@ class LeaveRequestCalendar:
                 break
         return {event['approval_id']: event for event in events}
     
-    def update_calendar_event(self, event_id, event_body):
+    def update_calendar_event(self, event_id, event_body, calendar_service=None):
         """Update an existing calendar event"""
+        if calendar_service is None:
+            calendar_service = self.calendar_service
         try:
-            self.calendar_service.events().update(
+            calendar_service.events().update(
                 calendarId=self.calendar_id,
                 eventId=event_id,
                 body=event_body,
@@ -397,10 +432,10 @@ class LeaveRequestCalendar:
             return {}
     
     def update_sheets_data(self, df, calendar_events_status):
-        """Update Google Sheets with leave request data"""
+        """Update Google Sheets with leave request data, returning False if the update failed"""
         if not self.sheets_id:
             logging.info("No Google Sheets ID provided, skipping sheets update")
-            return
+            return True
         
         try:
             # Set up headers first
@@ -447,14 +482,14 @@ class LeaveRequestCalendar:
                 # Prepare row data for non-deleted events
                 row_data = [
                     approval_id,
-                    row['First Name'],
-                    row['Last Name'], 
-                    row['Time Off Type'],
-                    row['Status'],
+                    row['First Name'] if pd.notna(row['First Name']) else '',
+                    row['Last Name'] if pd.notna(row['Last Name']) else '',
+                    row['Time Off Type'] if pd.notna(row['Time Off Type']) else '',
+                    row['Status'] if pd.notna(row['Status']) else '',
                     row['Start Time'].strftime('%Y-%m-%d %H:%M:%S') if pd.notna(row['Start Time']) else '',
                     row['End Time'].strftime('%Y-%m-%d %H:%M:%S') if pd.notna(row['End Time']) else '',
                     row['Substitute'] if pd.notna(row['Substitute']) else '',
-                    row['Sub Required?'],
+                    row['Sub Required?'] if pd.notna(row['Sub Required?']) else '',
                     row['Reason'] if pd.notna(row['Reason']) else '',
                     row['Additional comments'] if pd.notna(row['Additional comments']) else '',
                     datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
@@ -507,128 +542,289 @@ class LeaveRequestCalendar:
                     body={'values': new_rows}
                 ).execute()
                 logging.info(f"Added {len(new_rows)} new rows to Google Sheets")
+            return True
                 
         except Exception as e:
             logging.error(f"Error updating Google Sheets: {str(e)}")
+            return False
+    
+    def build_event_body(self, row):
+        """Build the Google Calendar event body for a leave request row"""
+        
+        # Create full name
+        full_name = f"{row['First Name']} {row['Last Name']}"
+        
+        return {
+            'summary': (f"{row['Substitute']} sub for {full_name} - {row['Time Off Type']}" 
+                        if pd.notna(row['Substitute']) and str(row['Substitute']).strip() != ''
+                        else f"NEEDS SUB - {full_name} - {row['Time Off Type']}"
+                        if row['Sub Required?'].lower() == 'yes'
+                        else f"{full_name} (No Sub) - {row['Time Off Type']}"),
+            'description': (f"Approval ID: {row['Approval ID']}\n\n"
+                            f"Reason: {row['Reason']}\n\n"
+                            f"Additional Comments: {row['Additional comments']}"),
+            'start': {
+                'dateTime': row['Start Time'].isoformat(),
+                'timeZone': 'America/New_York',
+            },
+            'end': {
+                'dateTime': row['End Time'].isoformat(),
+                'timeZone': 'America/New_York',
+            },
+            'reminders': {
+                'useDefault': True
+            }
+        }
+    
+    def sync_calendar_event(self, row, existing_events, calendar_service=None, approved_only=False):
+        """Create, update or delete the calendar event for one leave request and return its status
+        (approved_only stops requests that were never approved from being created, as a backfill needs)"""
+        
+        # Each thread needs its own API client, so a backfill passes one in
+        if calendar_service is None:
+            calendar_service = self.calendar_service
+        
+        full_name = f"{row['First Name']} {row['Last Name']}"
+        event = self.build_event_body(row)
+        
+        # Initialize approval_id
+        approval_id = str(row['Approval ID'])
+        
+        if approval_id in existing_events and (row['Status'] == 'Approved'): # or row['Status'] == 'Pending'):
+            # Path 1: Event exists - update it if needed
+            try:    
+                success = self.update_calendar_event(
+                    existing_events[approval_id]['event_id'],
+                    event,
+                    calendar_service
+                )
+                if success:
+                    print(f"Existing calendar event for {full_name}")
+                    return 'Updated'
+                return 'Update Failed'
+            except Exception as e:
+                print(f"Error updating calendar event for {full_name}: {str(e)}")
+                return 'Update Error'
+        elif approval_id in existing_events and (row['Status'] == 'Rejected' or row['Status'] == 'Revoked'):
+            # Path 2: Event exists - delete it
+            try:
+                calendar_service.events().delete(
+                    calendarId=self.calendar_id,
+                    eventId=existing_events[approval_id]['event_id'],
+                    sendUpdates='all'
+                ).execute()
+                print(f"Deleted calendar event for {full_name}")
+                try: 
+                    with self.deleted_lock:
+                        self.load_and_save_deleted_events(approval_id)
+                    print(f"Added event to deleted events: {approval_id}")
+                except Exception as e:
+                    print(f"Error adding event to deleted events: {str(e)}")
+                return 'Deleted'
+            except Exception as e:
+                print(f"Error deleting event: {str(e)}")
+                return 'Delete Error'
+        elif approval_id in self.deleted_set: 
+            # Path 3: Event was previously deleted - ignore it
+            return 'Previously Deleted'
+        elif approved_only and row['Status'] != 'Approved':
+            # Path 4: Rejected, revoked or pending request with no event - leave the calendar alone
+            return 'Not Approved'
+        else:
+            # Path 5: Completely new event - create a new event
+            try:
+                calendar_service.events().insert(
+                    calendarId=self.calendar_id,
+                    body=event,
+                    sendUpdates='all'
+                ).execute()
+                print(f"Created new calendar event for {full_name}")
+                return 'Created'
+            except Exception as e:
+                print(f"Error creating calendar event for {full_name}: {str(e)}")
+                return 'Create Error'
+    
+    def print_calendar_summary(self, calendar_events_status):
+        """Print how many events were created, updated, deleted, ignored and failed"""
+        statuses = list(calendar_events_status.values())
+        failed_count = sum(1 for status in statuses if status not in completed_statuses)
+        print(f"\nCalendar Summary:")
+        print(f"Created {statuses.count('Created')} new events")
+        print(f"Updated {statuses.count('Updated')} existing events")
+        print(f"Deleted {statuses.count('Deleted')} existing events")
+        print(f"Ignored {statuses.count('Previously Deleted')} previously deleted events")
+        if 'Not Approved' in statuses:
+            print(f"Skipped {statuses.count('Not Approved')} requests that were not approved")
+        print(f"Failed {failed_count} events")
     
     def create_calendar_events(self, excel_path):
         """Read Excel and create calendar events for each leave request"""
         
         # Read Excel file
-        df = pd.read_excel(excel_path)
-        
-        # Convert 'Start Time' and 'End Time' to datetime
-        df['Start Time'] = pd.to_datetime(df['Start Time']) 
-        df['End Time'] = pd.to_datetime(df['End Time'])
+        df = read_leave_requests_file(excel_path)
         
         # Get existing events
         existing_events = self.get_existing_events()
         
-        # Initialize counters
-        created_count = 0
-        existing_count = 0
-        deleted_count = 0
-        ignored_count = 0
-        
         # Track calendar event statuses for sheets update
         calendar_events_status = {}
         
         for _, row in df.iterrows():
-            # Create full name
-            full_name = f"{row['First Name']} {row['Last Name']}"
-            
-            event = {
-                'summary': (f"{row['Substitute']} sub for {full_name} - {row['Time Off Type']}" 
-                            if pd.notna(row['Substitute']) and str(row['Substitute']).strip() != ''
-                            else f"NEEDS SUB - {full_name} - {row['Time Off Type']}"
-                            if row['Sub Required?'].lower() == 'yes'
-                            else f"{full_name} (No Sub) - {row['Time Off Type']}"),
-                'description': (f"Approval ID: {row['Approval ID']}\n\n"
-                                f"Reason: {row['Reason']}\n\n"
-                                f"Additional Comments: {row['Additional comments']}"),
-                'start': {
-                    'dateTime': row['Start Time'].isoformat(),
-                    'timeZone': 'America/New_York',
-                },
-                'end': {
-                    'dateTime': row['End Time'].isoformat(),
-                    'timeZone': 'America/New_York',
-                },
-                'reminders': {
-                    'useDefault': True
-                }
-            }
-            
-            # Initialize approval_id
-            approval_id = str(row['Approval ID'])
-            
-            if approval_id in existing_events and (row['Status'] == 'Approved'): # or row['Status'] == 'Pending'):
-                # Path 1: Event exists - update it if needed
-                try:    
-                    success = self.update_calendar_event(
-                        existing_events[approval_id]['event_id'],
-                        event
-                    )
-                    if success:
-                        existing_count += 1
-                        calendar_events_status[approval_id] = 'Updated'
-                        print(f"Existing calendar event for {full_name}")
-                    else:
-                        calendar_events_status[approval_id] = 'Update Failed'
-                except Exception as e:
-                    calendar_events_status[approval_id] = 'Update Error'
-                    print(f"Error updating calendar event for {full_name}: {str(e)}")
-            elif approval_id in existing_events and (row['Status'] == 'Rejected' or row['Status'] == 'Revoked'):
-                # Path 2: Event exists - delete it
-                try:
-                    self.calendar_service.events().delete(
-                        calendarId=self.calendar_id,
-                        eventId=existing_events[approval_id]['event_id'],
-                        sendUpdates='all'
-                    ).execute()
-                    deleted_count += 1
-                    calendar_events_status[approval_id] = 'Deleted'
-                    print(f"Deleted calendar event for {full_name}")
-                    try: 
-                        self.load_and_save_deleted_events(approval_id)
-                        print(f"Added event to deleted events: {approval_id}")
-                    except Exception as e:
-                        print(f"Error adding event to deleted events: {str(e)}")
-                except Exception as e:
-                    calendar_events_status[approval_id] = 'Delete Error'
-                    print(f"Error deleting event: {str(e)}")
-            elif approval_id in self.deleted_set: 
-                # Path 3: Event was previously deleted - ignore it
-                ignored_count += 1
-                calendar_events_status[approval_id] = 'Previously Deleted'
-            else:
-                # Path 4: Completely new event - create a new event
+            calendar_events_status[str(row['Approval ID'])] = self.sync_calendar_event(row, existing_events)
+        
+        self.print_calendar_summary(calendar_events_status)
+        
+        # Update Google Sheets with all data
+        if self.sheets_id:
+            logging.info("Updating Google Sheets...")
+            if self.update_sheets_data(df, calendar_events_status):
+                print("Google Sheets updated successfully")
+    
+    def get_backfill_files(self, source):
+        """Get every Excel export in a directory or matching a glob, oldest first"""
+        if os.path.isdir(source):
+            source = os.path.join(source, '*.xlsx')
+        # Skip the "~$" lock files Excel leaves next to any export that is open
+        files = [f for f in glob.glob(source)
+                 if f.endswith('.xlsx') and not os.path.basename(f).startswith('~$')]
+        if not files:
+            raise FileNotFoundError(f"No Excel files found for backfill source: {source}")
+        return sorted(files, key=os.path.getmtime)
+    
+    def merge_excel_files(self, excel_files, parse_workers=None):
+        """Parse the exports in a process pool and keep the latest row for each Approval ID"""
+        frames = [None] * len(excel_files)
+        skipped_files = []
+        started = time.time()
+        
+        with ProcessPoolExecutor(max_workers=parse_workers) as executor:
+            futures = {executor.submit(read_leave_requests_file, path): i for i, path in enumerate(excel_files)}
+            for done, future in enumerate(as_completed(futures), 1):
+                excel_path = excel_files[futures[future]]
                 try:
-                    self.calendar_service.events().insert(
-                        calendarId=self.calendar_id,
-                        body=event,
-                        sendUpdates='all'
-                    ).execute()
-                    created_count += 1
-                    calendar_events_status[approval_id] = 'Created'
-                    print(f"Created new calendar event for {full_name}")
+                    frames[futures[future]] = future.result()
                 except Exception as e:
-                    calendar_events_status[approval_id] = 'Create Error'
-                    print(f"Error creating calendar event for {full_name}: {str(e)}")
+                    logging.error(f"Error reading Excel file {excel_path}, skipping it: {str(e)}")
+                    skipped_files.append(excel_path)
+                log_progress("Parsing exports", done, len(excel_files), started)
         
-        print(f"\nCalendar Summary:")
-        print(f"Created {created_count} new events")
-        print(f"Updated {existing_count} existing events")
-        print(f"Deleted {deleted_count} existing events")
-        print(f"Ignored {ignored_count} previously deleted events")
+        frames = [frame for frame in frames if frame is not None]
+        if not frames:
+            raise ValueError("None of the Excel files for the backfill could be read")
         
-        # Update Google Sheets with all data
+        # Files are ordered oldest first, so keeping the last row means the latest status wins
+        df = pd.concat(frames, ignore_index=True)
+        df = df.drop_duplicates(subset='Approval ID', keep='last').reset_index(drop=True)
+        logging.info(f"Merged {len(frames)} exports into {len(df)} unique leave requests")
+        if skipped_files:
+            logging.warning(f"Skipped {len(skipped_files)} unreadable exports: {', '.join(skipped_files)}")
+        return df
+    
+    def load_checkpoint(self, checkpoint_file, excel_files):
+        """Load the calendar statuses saved by an interrupted backfill of the same exports"""
+        try:
+            with open(checkpoint_file, 'r') as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return {}
+        
+        # A checkpoint for a different set of exports can't be trusted
+        if checkpoint.get('files') != excel_files:
+            logging.warning(f"Checkpoint {checkpoint_file} is for different exports, starting from the beginning")
+            return {}
+        
+        calendar_events_status = checkpoint.get('calendar_events_status', {})
+        logging.info(f"Resuming backfill with {len(calendar_events_status)} leave requests already processed")
+        return calendar_events_status
+    
+    def save_checkpoint(self, checkpoint_file, excel_files, calendar_events_status):
+        """Save backfill progress, writing to a temporary file first so an interruption can't corrupt it"""
+        temp_file = f"{checkpoint_file}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump({'files': excel_files, 'calendar_events_status': calendar_events_status}, f)
+        os.replace(temp_file, checkpoint_file)
+    
+    def backfill(self, source, parse_workers=None, max_concurrency=4, checkpoint_file=default_checkpoint_file, restart=False):
+        """Replay many Excel exports at once and apply a single deduplicated set of calendar and sheet changes"""
+        excel_files = [os.path.abspath(f) for f in self.get_backfill_files(source)]
+        logging.info(f"Backfilling from {len(excel_files)} Excel files")
+        
+        df = self.merge_excel_files(excel_files, parse_workers)
+        
+        # Pick up where an interrupted backfill stopped
+        calendar_events_status = {} if restart else self.load_checkpoint(checkpoint_file, excel_files)
+        pending = [row for _, row in df.iterrows()
+                   if calendar_events_status.get(row['Approval ID']) not in completed_statuses]
+        
+        existing_events = self.get_existing_events()
+        
+        # The API client isn't thread-safe, so every worker thread builds its own
+        thread_data = threading.local()
+        def sync_row(row):
+            # A bad row (e.g. a blank cell from an older export) is recorded as an error so the backfill carries on
+            try:
+                if not hasattr(thread_data, 'calendar_service'):
+                    thread_data.calendar_service = self.setup_google_calendar(self.service_account_file)
+                return self.sync_calendar_event(row, existing_events, thread_data.calendar_service,
+                                                approved_only=True)
+            except Exception as e:
+                logging.error(f"Error syncing calendar event for approval ID {row['Approval ID']}: {str(e)}")
+                return 'Sync Error'
+        
+        started = time.time()
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        try:
+            futures = {executor.submit(sync_row, row): row['Approval ID'] for row in pending}
+            for done, future in enumerate(as_completed(futures), 1):
+                calendar_events_status[futures[future]] = future.result()
+                if done % 25 == 0 or done == len(futures):
+                    self.save_checkpoint(checkpoint_file, excel_files, calendar_events_status)
+                    log_progress("Syncing calendar", done, len(futures), started)
+        finally:
+            # Stop queued work and record whatever finished if the backfill is interrupted
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.save_checkpoint(checkpoint_file, excel_files, calendar_events_status)
+        
+        self.print_calendar_summary(calendar_events_status)
+        
+        # Update Google Sheets once with the merged data
         if self.sheets_id:
             logging.info("Updating Google Sheets...")
-            self.update_sheets_data(df, calendar_events_status)
+            if not self.update_sheets_data(df, calendar_events_status):
+                # Keep the checkpoint so a rerun only retries the Sheets update
+                logging.error(f"Backfill did not finish updating Google Sheets, rerun to resume from {checkpoint_file}")
+                return
             print("Google Sheets updated successfully")
+        
+        # Keep the checkpoint so a rerun retries the rows that failed
+        failed = [approval_id for approval_id, status in calendar_events_status.items()
+                  if status not in completed_statuses]
+        if failed:
+            logging.warning(f"Backfill finished with {len(failed)} failed leave requests, "
+                            f"rerun to retry them from {checkpoint_file}")
+            return
+        
+        # The backfill finished, so there is nothing left to resume
+        os.remove(checkpoint_file)
+        logging.info("Backfill completed successfully")
+
+def parse_args():
+    """Read the command line options for a backfill"""
+    parser = argparse.ArgumentParser(description="Sync leave requests to Google Calendar and Sheets")
+    parser.add_argument('--backfill', metavar='PATH',
+                        help="Directory or glob of Excel exports to replay instead of downloading the latest one")
+    parser.add_argument('--parse-workers', type=int, default=None,
+                        help="Number of processes used to parse exports (defaults to the CPU count)")
+    parser.add_argument('--max-concurrency', type=int, default=4,
+                        help="Maximum number of calendar requests sent at once during a backfill")
+    parser.add_argument('--checkpoint', default=default_checkpoint_file,
+                        help="File used to save backfill progress so it can be resumed")
+    parser.add_argument('--restart', action='store_true',
+                        help="Ignore any saved checkpoint and start the backfill from the beginning")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
     try:
         logging.info("Starting leave request calendar update...")
         
@@ -641,6 +837,12 @@ def main():
         # Create calendar manager
         calendar_manager = LeaveRequestCalendar(service_account_file, CALENDAR_ID, SHEETS_ID)
         
+        # Replay a set of past exports instead of downloading a new one
+        if args.backfill:
+            calendar_manager.backfill(args.backfill, args.parse_workers, args.max_concurrency,
+                                      args.checkpoint, args.restart)
+            return
+        
         # Download Excel file
         logging.info("Downloading Excel file...")
         calendar_manager.download_excel()